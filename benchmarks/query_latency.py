@@ -0,0 +1,76 @@
+"""Time TimeSeriesBase.latest() and since() against increasingly large SQLite tables.
+
+With the (location, time) and time indexes in place, latency should stay flat as the table grows. Seeds a scratch
+SQLite db (not your configured one), so it is safe to run anywhere:
+
+    python benchmarks/query_latency.py --sizes 10000 100000 1000000 10000000
+"""
+import argparse
+import os
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+from therm import create_app
+from therm.models import db, Sample
+
+LOCATIONS = ("den", "kitchen")
+INSERT_CHUNK = 50000
+
+
+def _seed(n_rows, start_time):
+    """Grow the sample table to n_rows rows, one sample a minute per location."""
+    have = db.session.query(Sample).count()
+    rows = (
+        {
+            "time": start_time + timedelta(minutes=i // len(LOCATIONS)),
+            "temp": 60 + (i % 100) / 10.0,
+            "pressure": 100.0,
+            "location": LOCATIONS[i % len(LOCATIONS)],
+        }
+        for i in range(have, n_rows)
+    )
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK:
+            db.session.execute(Sample.__table__.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(Sample.__table__.insert(), chunk)
+    db.session.commit()
+
+
+def _time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+
+def main(sizes, repeat):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app = create_app("Test")
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///{}".format(db_path)
+    start_time = datetime(2018, 6, 1)
+    with app.app_context():
+        db.create_all()
+        print("{:>10} {:>12} {:>12} {:>12}".format("rows", "latest ms", "latest(loc)", "since(1h)"))
+        for n_rows in sorted(sizes):
+            _seed(n_rows, start_time)
+            end_time = Sample.latest().time
+            db.session.expire_all()
+            print(
+                "{:>10} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+                    n_rows,
+                    _time(lambda: Sample.latest(), repeat),
+                    _time(lambda: Sample.latest(location=LOCATIONS[0]), repeat),
+                    _time(lambda: Sample.since(end_time - timedelta(hours=1), location=LOCATIONS[0]), repeat),
+                )
+            )
+    os.remove(db_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    main(args.sizes, args.repeat)
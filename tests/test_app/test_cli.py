@@ -3,7 +3,7 @@ import pytest
 import threading
 
 import therm.cli as cli
-from therm.models import db, Sample, State
+from therm.models import db, Sample, State, Rollup
 
 
 @pytest.fixture
@@ -57,6 +57,7 @@ def test_read_write_temp(mock_mpl115, app, fake_states):
     cli._poll_once()
     mock_mpl115.read.assert_called_once()
     assert Sample.latest().temp == 10
+    assert [r.temp_sum for r in Rollup.query.all()] == [10, 10, 10]
 
 
 def test_thread_safe(mock_buttons, app, fake_states):
@@ -78,3 +79,20 @@ def test_thread_safe(mock_buttons, app, fake_states):
     after = State.latest()
     assert after.set_point == before.set_point + cli.TEMP_INCREMENT
     assert after.set_point_enabled
+
+
+def test_migrate_db(app, runner):
+    with app.app_context():
+        db.session.execute("DROP INDEX ix_sample_location_time")
+        db.session.commit()
+        result = runner.invoke(args=["migrate-db"])
+        assert "ix_sample_location_time" in result.output
+        result = runner.invoke(args=["migrate-db"])
+        assert "Created indexes: none" in result.output
+
+
+def test_rebuild_rollups(app, runner, fake_samples):
+    result = runner.invoke(args=["rebuild-rollups"])
+    assert "Wrote" in result.output
+    with app.app_context():
+        assert sum(r.count for r in Rollup.query.filter_by(resolution=86400)) == len(fake_samples)
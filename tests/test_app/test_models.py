@@ -2,7 +2,7 @@ import pytest
 import itertools
 from datetime import datetime, timedelta
 import random
-from therm.models import db, Sample, State, jointerpolate
+from therm.models import db, Sample, State, Rollup, jointerpolate
 
 START_TIME = datetime.strptime("2018-06-01T00:00:00", "%Y-%m-%dT%H:%M:%S")
 END_TIME = START_TIME + timedelta(hours=10)
@@ -132,3 +132,103 @@ def test_get_states(app, fake_states):
     latest = State.latest()
     assert latest
     assert latest.id == fake_states[-1].id
+
+
+def _query_plan(query):
+    statement = query.statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+    return " ".join(row[-1] for row in db.session.execute("EXPLAIN QUERY PLAN {}".format(statement)))
+
+
+def test_latest_uses_index(app, fake_samples):
+    plan = _query_plan(Sample.query.order_by(Sample.time.desc()).limit(1))
+    assert "ix_sample_time" in plan
+    assert "TEMP B-TREE" not in plan
+
+    plan = _query_plan(Sample.query.filter(Sample.location == "den").order_by(Sample.time.desc()).limit(1))
+    assert "ix_sample_location_time" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_since_location(app, fake_samples):
+    db.session.add(Sample(temp=50, time=END_TIME, location="den"))
+    db.session.commit()
+    assert [s.location for s in Sample.since(END_TIME - timedelta(minutes=15), location="den")] == ["den"]
+    assert len(Sample.since(END_TIME - timedelta(minutes=15))) == 2
+
+
+def test_since_bucketed(app, fake_samples):
+    bucketed = Sample.since_bucketed(START_TIME, END_TIME, n_buckets=10)
+    assert len(bucketed) == 10
+    assert bucketed.index[0] == START_TIME
+    expected = Sample.dataframe(fake_samples).temp
+    expected = expected[expected.index >= START_TIME].resample("3600S", origin=START_TIME).mean()
+    assert list(bucketed.temp.round(6)) == list(expected.round(6))
+
+    maxes = Sample.since_bucketed(START_TIME, END_TIME, n_buckets=10, agg="max")
+    assert (maxes.temp >= bucketed.temp).all()
+
+    with pytest.raises(ValueError):
+        Sample.since_bucketed(START_TIME, END_TIME, agg="median")
+
+
+def test_since_bucketed_min_width(app, fake_samples):
+    """Buckets are never narrower than a minute, and empty buckets are NaN."""
+    bucketed = Sample.since_bucketed(START_TIME, START_TIME + timedelta(minutes=30), n_buckets=60)
+    assert len(bucketed) == 30
+    assert bucketed.temp.isna().sum() >= 25
+
+
+def test_since_bucketed_states(app, fake_states):
+    bucketed = State.since_bucketed(START_TIME, END_TIME + timedelta(hours=2), n_buckets=12)
+    assert len(bucketed) == 12
+    # States stay in effect until the next one
+    assert not bucketed.set_point.isna().any()
+    assert set(bucketed.heat_on) == {0}
+
+
+def test_rollup_split():
+    start = START_TIME + timedelta(minutes=59, seconds=30)
+    pieces = Rollup.split(start, start + timedelta(minutes=2), 3600)
+    assert pieces == [(START_TIME, 30.0), (START_TIME + timedelta(hours=1), 90.0)]
+
+
+def test_rollup_incremental_matches_rebuild(app, fake_samples):
+    Rollup.rebuild()
+    rebuilt = {(r.resolution, r.time): (r.count, r.temp_sum, r.temp_min, r.temp_max) for r in Rollup.query.all()}
+    assert sum(r[0] for (res, _), r in rebuilt.items() if res == 3600) == len(fake_samples)
+
+    Rollup.query.delete()
+    for sample in fake_samples:
+        Rollup.add_sample(sample)
+    db.session.commit()
+    incremental = {(r.resolution, r.time): (r.count, r.temp_sum, r.temp_min, r.temp_max) for r in Rollup.query.all()}
+    assert incremental.keys() == rebuilt.keys()
+    for key, (count, temp_sum, temp_min, temp_max) in rebuilt.items():
+        assert incremental[key][0] == count
+        assert incremental[key][1] == pytest.approx(temp_sum)
+        assert incremental[key][2:] == (temp_min, temp_max)
+
+
+def test_rollup_heat_on_seconds(app):
+    db.session.add(State(time=START_TIME, set_point=70, set_point_enabled=True, heat_on=True))
+    db.session.add(State(time=START_TIME + timedelta(minutes=90), set_point=70, set_point_enabled=True))
+    db.session.add(State(time=START_TIME + timedelta(minutes=100), set_point=70, set_point_enabled=False))
+    db.session.commit()
+    Rollup.rebuild()
+    hours = Rollup.query.filter_by(resolution=3600).order_by(Rollup.time).all()
+    assert [r.heat_on_seconds for r in hours] == [3600, 1800]
+    assert [r.set_point_seconds for r in hours] == [3600, 2400]
+    day = Rollup.query.filter_by(resolution=86400).one()
+    assert day.heat_on_seconds == 5400
+    assert day.set_point_sum / day.set_point_seconds == 70
+
+
+def test_rollup_since_bucketed(app, fake_samples):
+    Rollup.rebuild()
+    assert Rollup.resolution_for(START_TIME, END_TIME, 10) == 3600
+    assert Rollup.resolution_for(START_TIME, END_TIME, 60) == 60
+    assert Rollup.resolution_for(START_TIME, START_TIME + timedelta(minutes=30), 60) is None
+    samples, states = Rollup.since_bucketed(3600, START_TIME, END_TIME, n_buckets=10)
+    raw = Sample.since_bucketed(START_TIME, END_TIME, n_buckets=10)
+    assert list(samples.temp.round(6)) == list(raw.temp.round(6))
+    assert len(states) == 10
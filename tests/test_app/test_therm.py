@@ -1,3 +1,5 @@
+import json
+
 import pandas as pd
 
 from therm.models import State, Sample
@@ -61,3 +63,22 @@ def test_get_chart_default(client, fake_samples, fake_states):
 def test_get_dashboard_default(client, fake_samples, fake_states):
     response = client.get("/")
     assert response.status_code == 200
+
+
+def test_get_samples_pages(client, fake_samples):
+    first = client.get("/samples?limit=20").get_json()
+    assert len(first) == 20
+    second = client.get("/samples", query_string={"after": first[-1]["time"], "limit": 20}).get_json()
+    assert len(second) == 20
+    assert second[0]["time"] > first[-1]["time"]
+    rest = client.get("/samples", query_string={"after": second[-1]["time"]}).get_json()
+    assert len(first) + len(second) + len(rest) == len(fake_samples)
+
+
+def test_get_samples_ndjson(client, fake_samples):
+    tmin = sorted(s.time for s in fake_samples)[10].isoformat()
+    response = client.get("/samples", query_string={"format": "ndjson", "tmin": tmin})
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == len(fake_samples) - 10
+    assert all(json.loads(line)["time"] >= tmin for line in lines)
@@ -13,7 +13,7 @@ from flask.cli import with_appcontext
 import boto3
 
 from . import relay, buttons, mpl115
-from .models import Sample, db, State
+from .models import Sample, db, State, Rollup, create_missing_indexes
 
 POLL_LOCKFILE = "/tmp/polling"
 """Lock file for polling process."""
@@ -34,6 +34,8 @@ def _poll_once(to_sqs=False):
         sample = Sample(temp=temp, pressure=pressure)
         click.echo("Temp {}".format(temp))
         db.session.add(sample)
+        db.session.flush()
+        Rollup.add_sample(sample)
         db.session.commit()
 
     if to_sqs:
@@ -212,7 +214,7 @@ def populate_db_command():
 @with_appcontext
 def truncate_db_command():
     """Truncate db tables."""
-    tables = [Sample, State]
+    tables = [Sample, State, Rollup]
     for table in tables:
         db.session.query(table).delete()
     click.echo("Truncated {}".format(", ".join([t.__table__.name for t in tables])))
@@ -234,6 +236,24 @@ def init_db_command():
     click.echo("Initialized {}.".format(current_app.config["DB_URL"]))
 
 
+@click.command("migrate-db")
+@with_appcontext
+def migrate_db_command():
+    """Bring an existing db up to date with the models (create missing tables and indexes)."""
+    db.create_all()
+    created = create_missing_indexes()
+    click.echo("Created indexes: {}".format(", ".join(created) if created else "none"))
+    click.echo("Migrated {}.".format(current_app.config["DB_URL"]))
+
+
+@click.command("rebuild-rollups")
+@with_appcontext
+def rebuild_rollups_command():
+    """Recompute the minute/hour/day rollups from raw samples and states."""
+    written = Rollup.rebuild()
+    click.echo("Wrote {} rollups.".format(written))
+
+
 def get_account_id():
     # suggested by https://groups.google.com/forum/#!topic/boto-users/QhASXlNBm40
     return boto3.client("sts").get_caller_identity().get("Account")
@@ -326,6 +346,8 @@ def init_app(app):
         truncate_db_command,
         drop_db_command,
         init_db_command,
+        migrate_db_command,
+        rebuild_rollups_command,
         create_alarms_command,
         set_hold,
         unset_hold,
@@ -1,16 +1,63 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import math
 
 
 from flask_sqlalchemy import SQLAlchemy, Model
 import pandas as pd
+from sqlalchemy import inspect, func, Integer, Float, Boolean
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql.expression import FunctionElement
 
 
 DEFAULT_LOCATION = None
 
+EPOCH = datetime(1970, 1, 1)
+MIN_BUCKET_SECONDS = 60
+"""Don't bucket more finely than one minute."""
+BUCKET_AGGREGATES = ("avg", "min", "max", "sum")
+
 db = SQLAlchemy()
 
 
+class epoch(FunctionElement):
+    """Seconds since the unix epoch of a (naive, UTC) DateTime expression."""
+
+    type = Float()
+    name = "epoch"
+    inherit_cache = True
+
+
+@compiles(epoch)
+def _epoch_default(element, compiler, **kw):
+    return "EXTRACT(EPOCH FROM {})".format(compiler.process(element.clauses, **kw))
+
+
+@compiles(epoch, "sqlite")
+def _epoch_sqlite(element, compiler, **kw):
+    # julianday() is a float of days; round off its error so times on bucket boundaries land in the right bucket
+    return "ROUND((julianday({}) - 2440587.5) * 86400.0, 3)".format(compiler.process(element.clauses, **kw))
+
+
+class floor(FunctionElement):
+    """Round a non-negative number down to an integer."""
+
+    type = Integer()
+    name = "floor"
+    inherit_cache = True
+
+
+@compiles(floor)
+def _floor_default(element, compiler, **kw):
+    return "CAST(FLOOR({}) AS INTEGER)".format(compiler.process(element.clauses, **kw))
+
+
+@compiles(floor, "sqlite")
+def _floor_sqlite(element, compiler, **kw):
+    # SQLite has no FLOOR() unless built with math functions; truncation is the same for non-negative numbers
+    return "CAST({} AS INTEGER)".format(compiler.process(element.clauses, **kw))
+
+
 def jointerpolate(objs, max_points=50):
     """Join the indexes of multiple timeseries and interpolate onto the joined set of index points"""
     new_index = pd.concat(objs, axis=0, sort=True).sort_index().index
@@ -24,15 +71,63 @@ def jointerpolate(objs, max_points=50):
     return (o.resample(periodsize).first() for o in objs)
 
 
+def _bucket_width(tmin, tmax, n_buckets, min_width=MIN_BUCKET_SECONDS):
+    """Width in seconds and count of the buckets dividing [tmin, tmax) into at most n_buckets."""
+    span = (tmax - tmin).total_seconds()
+    width = max(span / n_buckets, min_width)
+    return width, max(int(math.ceil(span / width)), 1)
+
+
+def _bucket(time_column, tmin, width):
+    """SQL expression for the index of the `width` second bucket, counting from tmin, that time_column falls in."""
+    return floor((epoch(time_column) - (tmin - EPOCH).total_seconds()) / width).label("bucket")
+
+
+def _bucket_frame(rows, columns, tmin, width, n_buckets):
+    """DataFrame of (bucket, *columns) rows, with every bucket present and indexed by its start time."""
+    df = pd.DataFrame.from_records(rows, columns=["bucket"] + columns, index="bucket")
+    df = df.reindex(range(n_buckets)).astype(float)
+    df.index = pd.date_range(tmin, periods=n_buckets, freq=pd.Timedelta(seconds=width))
+    return df
+
+
+def create_missing_indexes():
+    """Create declared indexes that are missing from an existing database.
+
+    `db.create_all()` skips tables that already exist, so databases created before an index was added to a model need
+    this to pick it up. Safe to run repeatedly.
+
+    Returns:
+        list(str): names of the indexes created
+
+    """
+    created = []
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+    return created
+
+
 class TimeSeriesBase(object):
     """Shared functionality for therm models."""
 
     DEFAULT_TIMESERIES = None
+    FILL_FORWARD = False
+    """Whether a row stays in effect until the next one, i.e. empty buckets take the previous bucket's value."""
 
     @classmethod
     def latest(cls, limit=1, location=None, strict=False):
         """Return most recent row(s)
 
+        With a location this is a backwards scan of the (location, time) index, without one a backwards scan of the
+        time index; either way it reads `limit` index entries rather than sorting the table.
+
         Args:
             limit (int): num rows
             location (str): filter by location
@@ -43,7 +138,7 @@ class TimeSeriesBase(object):
         """
         query = cls.query
         if location:
-            query = query.filter_by(location=location)
+            query = query.filter(cls.location == location)
         query = query.order_by(cls.time.desc())
         if limit == 1:
             try:
@@ -57,23 +152,105 @@ class TimeSeriesBase(object):
             return list(reversed(query.limit(limit).all()))
 
     @classmethod
-    def since(cls, tmin, tmax=None, limit=10000):
-        """
+    def since(cls, tmin, tmax=None, limit=10000, location=None):
+        """Return rows in [tmin, tmax), oldest first.
+
+        The time bounds are a range scan on the (location, time) index when a location is given, else on the time index.
 
         Args:
-            tmin:
-            tmax:
+            tmin (datetime): inclusive lower bound
+            tmax (datetime): exclusive upper bound, or None for no upper bound
+            limit (int): max rows
+            location (str): filter by location
 
         Returns:
+            list(cls): rows
 
         """
         query = cls.query
+        if location:
+            query = query.filter(cls.location == location)
         query = query.filter(cls.time >= tmin)
         if tmax:
             query = query.filter(cls.time < tmax)
         query = query.order_by(cls.time.asc())
         return query.limit(limit).all()
 
+    @classmethod
+    def since_bucketed(cls, tmin, tmax=None, n_buckets=60, agg="avg", location=None):
+        """Aggregate rows in [tmin, tmax) into evenly spaced time buckets, in the database.
+
+        Buckets are at least MIN_BUCKET_SECONDS wide. Float columns are aggregated with `agg`; boolean columns with max,
+        i.e. True if they were True at any point in the bucket. Only one row per bucket leaves the database, so the
+        cost doesn't grow with the length of the range.
+
+        Args:
+            tmin (datetime): inclusive lower bound
+            tmax (datetime): exclusive upper bound, default now
+            n_buckets (int): max number of buckets
+            agg (str): one of BUCKET_AGGREGATES
+            location (str): filter by location
+
+        Returns:
+            pd.DataFrame: one row per bucket, indexed by bucket start time; NaN for buckets with no rows
+
+        """
+        if agg not in BUCKET_AGGREGATES:
+            raise ValueError("agg must be one of {}, not {!r}".format(", ".join(BUCKET_AGGREGATES), agg))
+        tmax = tmax or datetime.utcnow()
+        width, n_buckets = _bucket_width(tmin, tmax, n_buckets)
+
+        bucket = _bucket(cls.time, tmin, width)
+        columns = []
+        for column in cls.__table__.columns:
+            if isinstance(column.type, Float):
+                columns.append(getattr(func, agg)(column).label(column.name))
+            elif isinstance(column.type, Boolean):
+                columns.append(func.max(func.cast(column, Integer)).label(column.name))
+
+        query = db.session.query(bucket, *columns).filter(cls.time >= tmin, cls.time < tmax)
+        if location:
+            query = query.filter(cls.location == location)
+        rows = query.group_by(bucket).all()
+
+        df = _bucket_frame(rows, [c.name for c in columns], tmin, width, n_buckets)
+        if cls.FILL_FORWARD:
+            df = df.ffill()
+        return df
+
+    @classmethod
+    def stream(cls, tmin=None, tmax=None, after=None, location=None, limit=None, chunk_size=1000):
+        """Iterate over rows oldest first without loading them all into memory.
+
+        Rows are fetched `chunk_size` at a time from a server-side cursor, so memory use doesn't grow with the size of
+        the table. `after` is a keyset cursor: pass the time of the last row of one page to get the next.
+
+        Args:
+            tmin (datetime): inclusive lower bound
+            tmax (datetime): exclusive upper bound
+            after (datetime): exclusive lower bound
+            location (str): filter by location
+            limit (int): max rows
+            chunk_size (int): rows per fetch
+
+        Returns:
+            iterator(cls): rows
+
+        """
+        query = cls.query
+        if location:
+            query = query.filter(cls.location == location)
+        if tmin:
+            query = query.filter(cls.time >= tmin)
+        if after:
+            query = query.filter(cls.time > after)
+        if tmax:
+            query = query.filter(cls.time < tmax)
+        query = query.order_by(cls.time.asc())
+        if limit:
+            query = query.limit(limit)
+        return query.yield_per(chunk_size)
+
     def _asdict(self):
         d = {}
         for column in self.__table__.columns:
@@ -109,25 +286,22 @@ class TimeSeriesBase(object):
 
 
 class State(TimeSeriesBase, db.Model):
+    __table_args__ = (db.Index("ix_state_location_time", "location", "time"),)
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    time = db.Column(db.DateTime, default=datetime.utcnow)
+    time = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     set_point = db.Column(db.Float, nullable=False)
     set_point_enabled = db.Column(db.Boolean, nullable=False, default=False)
     heat_on = db.Column(db.Boolean, nullable=False, default=False)
     location = db.Column(db.String(20), default=DEFAULT_LOCATION)
 
     DEFAULT_TIMESERIES = "set_point"
+    FILL_FORWARD = True
 
     @classmethod
     def refresh(cls):
         """Rewrite the latest state"""
-        current_state = cls.latest()
-        new_attrs = current_state._asdict()
-        new_attrs.pop("id")
-        new_attrs.pop("time")
-        new_state = cls(**new_attrs)
-        db.session.add(new_state)
-        db.session.commit()
+        cls._append(cls.latest())
 
     @classmethod
     def update_state(cls, attr_name, value):
@@ -142,17 +316,25 @@ class State(TimeSeriesBase, db.Model):
         """
         current_state = cls.latest()
         if getattr(current_state, attr_name) != value:
-            new_attrs = current_state._asdict()
-            new_attrs.pop("id")
-            new_attrs.pop("time")
-            new_attrs[attr_name] = value
-            new_state = cls(**new_attrs)
-            db.session.add(new_state)
-            db.session.commit()
+            cls._append(current_state, **{attr_name: value})
             return True
         else:
             return False
 
+    @classmethod
+    def _append(cls, current_state, **changes):
+        """Insert a copy of current_state with `changes` applied, and credit current_state's interval to the rollups."""
+        new_attrs = current_state._asdict()
+        new_attrs.pop("id")
+        new_attrs.pop("time")
+        new_attrs.update(changes)
+        new_state = cls(**new_attrs)
+        db.session.add(new_state)
+        db.session.flush()
+        Rollup.add_state(current_state, current_state.time, new_state.time)
+        db.session.commit()
+        return new_state
+
     def __repr__(self):
         return "<State {}: Set {}, Set temp {}, Heat on {}>".format(
             self.time.strftime("%Y-%m-%d %H:%M"), self.set_point_enabled, self.set_point, self.heat_on
@@ -160,8 +342,10 @@ class State(TimeSeriesBase, db.Model):
 
 
 class Sample(TimeSeriesBase, db.Model):
+    __table_args__ = (db.Index("ix_sample_location_time", "location", "time"),)
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    time = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    time = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
     temp = db.Column(db.Float, nullable=False)
     pressure = db.Column(db.Float)
     location = db.Column(db.String(20), default=DEFAULT_LOCATION)
@@ -174,6 +358,245 @@ class Sample(TimeSeriesBase, db.Model):
         )
 
 
+ROLLUP_RESOLUTIONS = (60, 3600, 86400)
+"""Rollup bucket widths in seconds: minute, hour, day."""
+
+
+class Rollup(db.Model):
+    """Per-bucket aggregates of Samples and States, maintained incrementally as they're written.
+
+    Sums rather than means are stored so a bucket can be updated in place and buckets can be combined exactly.
+    Set point and heat-on are credited in seconds, by the interval each State was in effect.
+    """
+
+    __table_args__ = (db.Index("ix_rollup_resolution_location_time", "resolution", "location", "time"),)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    resolution = db.Column(db.Integer, nullable=False)
+    time = db.Column(db.DateTime, nullable=False)
+    location = db.Column(db.String(20), default=DEFAULT_LOCATION)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    temp_min = db.Column(db.Float)
+    temp_max = db.Column(db.Float)
+    temp_sum = db.Column(db.Float, nullable=False, default=0.0)
+    pressure_sum = db.Column(db.Float, nullable=False, default=0.0)
+    pressure_count = db.Column(db.Integer, nullable=False, default=0)
+    heat_on_seconds = db.Column(db.Float, nullable=False, default=0.0)
+    set_point_seconds = db.Column(db.Float, nullable=False, default=0.0)
+    """Seconds with the set point enabled"""
+    set_point_sum = db.Column(db.Float, nullable=False, default=0.0)
+    """Enabled set point times seconds, i.e. set_point_sum / set_point_seconds is the time weighted mean set point."""
+
+    @classmethod
+    def empty(cls, resolution, time, location):
+        return cls(
+            resolution=resolution,
+            time=time,
+            location=location,
+            count=0,
+            temp_sum=0.0,
+            pressure_sum=0.0,
+            pressure_count=0,
+            heat_on_seconds=0.0,
+            set_point_seconds=0.0,
+            set_point_sum=0.0,
+        )
+
+    @staticmethod
+    def bucket_start(time, resolution):
+        return EPOCH + timedelta(seconds=((time - EPOCH).total_seconds() // resolution) * resolution)
+
+    @staticmethod
+    def split(start, end, resolution):
+        """Split [start, end) at bucket boundaries.
+
+        Returns:
+            list(tuple(datetime, float)): (bucket start, seconds of [start, end) in that bucket)
+        """
+        pieces = []
+        bucket = Rollup.bucket_start(start, resolution)
+        while bucket < end:
+            next_bucket = bucket + timedelta(seconds=resolution)
+            pieces.append((bucket, (min(end, next_bucket) - max(start, bucket)).total_seconds()))
+            bucket = next_bucket
+        return pieces
+
+    @property
+    def temp(self):
+        return self.temp_sum / self.count if self.count else None
+
+    @property
+    def pressure(self):
+        return self.pressure_sum / self.pressure_count if self.pressure_count else None
+
+    def _add_sample(self, temp, pressure):
+        self.count += 1
+        self.temp_sum += temp
+        self.temp_min = temp if self.temp_min is None else min(self.temp_min, temp)
+        self.temp_max = temp if self.temp_max is None else max(self.temp_max, temp)
+        if pressure is not None:
+            self.pressure_sum += pressure
+            self.pressure_count += 1
+
+    def _add_state(self, state, seconds):
+        if state.heat_on:
+            self.heat_on_seconds += seconds
+        if state.set_point_enabled:
+            self.set_point_seconds += seconds
+            self.set_point_sum += state.set_point * seconds
+
+    @classmethod
+    def _get_or_create(cls, resolution, time, location):
+        rollup = cls.query.filter(
+            cls.resolution == resolution, cls.location == location, cls.time == time
+        ).one_or_none()
+        if rollup is None:
+            rollup = cls.empty(resolution, time, location)
+            db.session.add(rollup)
+        return rollup
+
+    @classmethod
+    def add_sample(cls, sample):
+        """Add a sample to its bucket at each resolution. Caller commits."""
+        for resolution in ROLLUP_RESOLUTIONS:
+            rollup = cls._get_or_create(resolution, cls.bucket_start(sample.time, resolution), sample.location)
+            rollup._add_sample(sample.temp, sample.pressure)
+
+    @classmethod
+    def add_state(cls, state, start, end):
+        """Credit `state` as in effect from start to end to the overlapping buckets. Caller commits."""
+        for resolution in ROLLUP_RESOLUTIONS:
+            for bucket, seconds in cls.split(start, end, resolution):
+                cls._get_or_create(resolution, bucket, state.location)._add_state(state, seconds)
+
+    @classmethod
+    def rebuild(cls, chunk=timedelta(days=1)):
+        """Recompute all rollups from the raw Sample and State tables.
+
+        Works through history `chunk` at a time, so memory use is bounded by the rows in one chunk.
+
+        Returns:
+            int: number of rollup rows written
+        """
+        cls.query.delete()
+        db.session.commit()
+        first = [t for t in (db.session.query(func.min(m.time)).scalar() for m in (Sample, State)) if t]
+        if not first:
+            return 0
+        chunk_start = cls.bucket_start(min(first), ROLLUP_RESOLUTIONS[-1])
+        end = max(db.session.query(func.max(m.time)).scalar() or chunk_start for m in (Sample, State))
+        last_states = {}
+        written = 0
+        while chunk_start <= end:
+            chunk_end = chunk_start + chunk
+            rollups = {}
+
+            def bucket(resolution, time, location):
+                key = (resolution, cls.bucket_start(time, resolution), location)
+                if key not in rollups:
+                    rollups[key] = cls.empty(*key)
+                return rollups[key]
+
+            samples = db.session.query(Sample.time, Sample.location, Sample.temp, Sample.pressure).filter(
+                Sample.time >= chunk_start, Sample.time < chunk_end
+            )
+            for time, location, temp, pressure in samples:
+                for resolution in ROLLUP_RESOLUTIONS:
+                    bucket(resolution, time, location)._add_sample(temp, pressure)
+
+            states = State.query.filter(State.time >= chunk_start, State.time < chunk_end).order_by(State.time.asc())
+            for state in states:
+                previous = last_states.get(state.location)
+                if previous is not None:
+                    for resolution in ROLLUP_RESOLUTIONS:
+                        for start, seconds in cls.split(previous.time, state.time, resolution):
+                            bucket(resolution, start, state.location)._add_state(previous, seconds)
+                last_states[state.location] = state
+
+            # Day buckets can straddle chunks when chunk isn't a whole number of days; merge into what's written
+            for (resolution, time, location), rollup in rollups.items():
+                if chunk_start <= time and time + timedelta(seconds=resolution) <= chunk_end:
+                    db.session.add(rollup)
+                else:
+                    existing = cls._get_or_create(resolution, time, location)
+                    existing._merge(rollup)
+            written += len(rollups)
+            db.session.commit()
+            chunk_start = chunk_end
+        return written
+
+    def _merge(self, other):
+        self.count += other.count
+        self.temp_sum += other.temp_sum
+        for attr, agg in (("temp_min", min), ("temp_max", max)):
+            values = [v for v in (getattr(self, attr), getattr(other, attr)) if v is not None]
+            setattr(self, attr, agg(values) if values else None)
+        self.pressure_sum += other.pressure_sum
+        self.pressure_count += other.pressure_count
+        self.heat_on_seconds += other.heat_on_seconds
+        self.set_point_seconds += other.set_point_seconds
+        self.set_point_sum += other.set_point_sum
+
+    @staticmethod
+    def resolution_for(tmin, tmax, n_buckets):
+        """Coarsest rollup resolution that still gives n_buckets buckets over [tmin, tmax), or None if none does."""
+        width = (tmax - tmin).total_seconds() / n_buckets
+        fits = [r for r in ROLLUP_RESOLUTIONS if r <= width]
+        return max(fits) if fits else None
+
+    @classmethod
+    def since_bucketed(cls, resolution, tmin, tmax=None, n_buckets=60, location=None):
+        """Combine `resolution` rollups in [tmin, tmax) into at most n_buckets buckets.
+
+        Returns frames shaped like Sample.since_bucketed() and State.since_bucketed(), so they can be used in their place.
+
+        Returns:
+            tuple(pd.DataFrame, pd.DataFrame): samples (temp, temp_min, temp_max, pressure, count),
+                states (set_point, set_point_enabled, heat_on, heat_on_seconds)
+
+        """
+        tmax = tmax or datetime.utcnow()
+        width, n_buckets = _bucket_width(tmin, tmax, n_buckets, min_width=resolution)
+        bucket = _bucket(cls.time, tmin, width)
+        names = [
+            "count",
+            "temp_sum",
+            "temp_min",
+            "temp_max",
+            "pressure_sum",
+            "pressure_count",
+            "heat_on_seconds",
+            "set_point_seconds",
+            "set_point_sum",
+        ]
+        aggs = [func.min if n == "temp_min" else func.max if n == "temp_max" else func.sum for n in names]
+        query = db.session.query(
+            bucket, *[agg(getattr(cls, name)).label(name) for name, agg in zip(names, aggs)]
+        ).filter(cls.resolution == resolution, cls.time >= tmin, cls.time < tmax)
+        if location:
+            query = query.filter(cls.location == location)
+        sums = _bucket_frame(query.group_by(bucket).all(), names, tmin, width, n_buckets)
+
+        samples = pd.DataFrame(index=sums.index)
+        samples["temp"] = sums.temp_sum / sums["count"].where(sums["count"] > 0)
+        samples["temp_min"] = sums.temp_min
+        samples["temp_max"] = sums.temp_max
+        samples["pressure"] = sums.pressure_sum / sums.pressure_count.where(sums.pressure_count > 0)
+        samples["count"] = sums["count"]
+
+        states = pd.DataFrame(index=sums.index)
+        states["set_point"] = sums.set_point_sum / sums.set_point_seconds.where(sums.set_point_seconds > 0)
+        states["set_point_enabled"] = (sums.set_point_seconds > 0).astype(float)
+        states["heat_on"] = (sums.heat_on_seconds > 0).astype(float)
+        states["heat_on_seconds"] = sums.heat_on_seconds
+        return samples, states
+
+    def __repr__(self):
+        return "<Rollup {}s {} {}: {} samples>".format(
+            self.resolution, self.time.strftime("%Y-%m-%d %H:%M"), self.location, self.count
+        )
+
+
 class Schedule(db.Model):
     day_of_week = db.Column(db.String(20), primary_key=True)
     time_of_day = db.Column(db.Time, primary_key=True)
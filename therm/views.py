@@ -1,18 +1,67 @@
 from datetime import datetime, timedelta
+import json
 import pytz
 
 from dateutil.parser import parse
 import pandas as pd
 import numpy as np
 
-from flask import current_app, Blueprint, render_template, jsonify, request
+from flask import current_app, Blueprint, render_template, jsonify, request, Response, stream_with_context
 
-from .models import db, Sample, State, jointerpolate
+from .models import db, Sample, State, Rollup
 
 root = Blueprint("root", __name__, url_prefix="")
 
 # Maximum points to plot on the on-device (small) chart
 MAX_GRAPH_POINTS = 60
+# Rows fetched per round trip when streaming /samples and /states
+STREAM_CHUNK_SIZE = 1000
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def _stream_rows(cls):
+    """Stream rows of `cls` matching the request args as a JSON array, or NDJSON if `format=ndjson`.
+
+    Times are ISO 8601, so the time of the last row of a page can be passed back as `after` to get the next page.
+
+    Request.args:
+        tmin: inclusive lower time bound
+        tmax: exclusive upper time bound
+        after: exclusive lower time bound (keyset cursor)
+        location: filter by location
+        limit: max rows
+        format: "json" (default) or "ndjson"
+    """
+    args = request.args
+    rows = cls.stream(
+        tmin=parse(args["tmin"]) if "tmin" in args else None,
+        tmax=parse(args["tmax"]) if "tmax" in args else None,
+        after=parse(args["after"]) if "after" in args else None,
+        location=args.get("location"),
+        limit=args.get("limit", type=int),
+        chunk_size=STREAM_CHUNK_SIZE,
+    )
+
+    if args.get("format") == "ndjson":
+
+        def generate():
+            for row in rows:
+                yield json.dumps(row._asdict(), default=_json_default) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    def generate():
+        yield "["
+        for i, row in enumerate(rows):
+            yield ("," if i else "") + json.dumps(row._asdict(), default=_json_default)
+        yield "]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
 
 @root.route("/samples/latest")
@@ -23,8 +72,7 @@ def latest_sample():
 
 @root.route("/samples")
 def samples():
-    res = Sample.query.all()
-    return jsonify([r._asdict() for r in res])
+    return _stream_rows(Sample)
 
 
 @root.route("/states/latest")
@@ -38,8 +86,7 @@ def latest_state():
 
 @root.route("/states")
 def states():
-    res = State.query.all()
-    return jsonify([r._asdict() for r in res])
+    return _stream_rows(State)
 
 
 def datetimefilter(value, format="%I:%M %p"):
@@ -75,8 +122,9 @@ def _plot_temps_states(temps, states):
     else:
         labels = []
     # current_app.logger.debug("\nLabels: {}\nValues: {}".format(", ".join(labels), ", ".join(temp_values_fmt)))
-    ymin = np.min(temps.temp) - 4 if len(temps) > 1 else 0
-    ymax = np.max(temps.temp) + 4 if len(temps) > 1 else 100
+    has_temps = len(temps) > 1 and temps.temp.count() > 0
+    ymin = np.nanmin(temps.temp) - 4 if has_temps else 0
+    ymax = np.nanmax(temps.temp) + 4 if has_temps else 100
     # ymax = max([s for s in temp_values + on_sets + [100]]) + 1
     return {
         "labels": labels,
@@ -105,17 +153,25 @@ def _get_heat():
     return "On" if state.heat_on else "Off"
 
 def _get_samples_states(hours=None, t0=None, t1=None):
+    """Bucketed samples and states for the requested range, at most MAX_GRAPH_POINTS rows each.
+
+    Uses the coarsest rollup with enough resolution, and only falls back to the raw tables for short ranges.
+    """
     if not (t0 and t1):
         hours = float(hours) if hours else 12
-        t0 = datetime.utcnow() - timedelta(hours=hours)
-        t1 = None
+        t1 = datetime.utcnow()
+        t0 = t1 - timedelta(hours=hours)
     else:
         t0 = parse(t0)
         t1 = parse(t1)
-    samples_df = Sample.dataframe(Sample.since(tmin=t0, tmax=t1))
-    states_df = State.dataframe(State.since(tmin=t0, tmax=t1))
+    resolution = Rollup.resolution_for(t0, t1, MAX_GRAPH_POINTS)
+    if resolution:
+        return Rollup.since_bucketed(resolution, tmin=t0, tmax=t1, n_buckets=MAX_GRAPH_POINTS)
+    samples_df = Sample.since_bucketed(tmin=t0, tmax=t1, n_buckets=MAX_GRAPH_POINTS)
+    states_df = State.since_bucketed(tmin=t0, tmax=t1, n_buckets=MAX_GRAPH_POINTS)
     return samples_df, states_df
 
+
 def _template_params():
     latest_state = State.latest()
     latest_sample = Sample.latest()
@@ -136,8 +192,7 @@ def chart():
         hours: latest `hours` hours, default 12
     """
     samples_df, states_df = _get_samples_states(**(request.args.to_dict()))
-    resampled_samples, resampled_states = jointerpolate([samples_df, states_df], max_points=MAX_GRAPH_POINTS)
-    temp_graph_params = _plot_temps_states(resampled_samples, resampled_states)
+    temp_graph_params = _plot_temps_states(samples_df, states_df)
     temp_graph_params.update(_template_params())
     return render_template("chart.html", **temp_graph_params)
 
@@ -174,7 +229,6 @@ def setpt_down():
 @root.route("/")
 def dashboard():
     samples_df, states_df = _get_samples_states(**(request.args.to_dict()))
-    resampled_samples, resampled_states = jointerpolate([samples_df, states_df], max_points=MAX_GRAPH_POINTS)
-    temp_graph_params = _plot_temps_states(resampled_samples, resampled_states)
+    temp_graph_params = _plot_temps_states(samples_df, states_df)
     temp_graph_params.update(_template_params())
     return render_template("dashboard.html", **temp_graph_params)